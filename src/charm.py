@@ -5,16 +5,23 @@
 # Learn more at: https://juju.is/docs/sdk
 
 import contextlib
+import hashlib
 import ipaddress
+import json
 import logging
+import re
+import time
+from typing import Dict, Iterable, List, Optional
 
 import ops
 from lightkube import Client
 from lightkube.core.exceptions import ApiError
 from lightkube.generic_resource import create_namespaced_resource
+from lightkube.resources.apps_v1 import DaemonSet, Deployment
+from lightkube.resources.core_v1 import Namespace, Service
 from ops import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 from ops.main import main
-from ops.manifests import Collector, ManifestClientError, Manifests
+from ops.manifests import Collector, HashableResource, ManifestClientError, Manifests
 from tenacity import before_log, retry, retry_if_exception_type, stop_after_delay, wait_exponential
 
 from metallb_manifests import MetallbNativeManifest
@@ -22,6 +29,10 @@ from metallb_manifests import MetallbNativeManifest
 # Log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
 
+# charm config which changes the rendered manifest objects
+MANIFEST_CONFIG_KEYS = ("namespace", "image-registry", "metallb-release", "node-selector")
+PEER_RELATION = "replicas"
+
 
 def _missing_resources(manifest: Manifests):
     expected = manifest.resources
@@ -30,6 +41,25 @@ def _missing_resources(manifest: Manifests):
     return missing
 
 
+def _manifest_digests(resources: Iterable[HashableResource]) -> Dict[str, str]:
+    """Map each rendered manifest object to a short digest of its content."""
+    return {
+        str(rsc): hashlib.sha256(
+            json.dumps(rsc.resource.to_dict(), sort_keys=True).encode()
+        ).hexdigest()[:16]
+        for rsc in resources
+    }
+
+
+def _manifest_revision(manifest: Manifests) -> str:
+    """Digest the bundled manifest files of the current release."""
+    release_path = manifest.manifest_path / manifest.current_release
+    content = hashlib.sha256()
+    for path in sorted(release_path.glob("*.y*ml")):
+        content.update(path.read_bytes())
+    return content.hexdigest()[:16]
+
+
 def _is_ip_address(str_to_test):
     try:
         ipaddress.ip_address(str_to_test)
@@ -73,6 +103,71 @@ def validate_iprange(iprange):
     return True, ""
 
 
+# https://kubernetes.io/docs/concepts/overview/working-with-objects/names/
+_DNS_LABEL = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$")
+_DNS_SUBDOMAIN = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*$")
+_LABEL_NAME = re.compile(r"^[A-Za-z0-9]([-A-Za-z0-9_.]*[A-Za-z0-9])?$")
+
+
+def _is_namespace_name(name: str) -> bool:
+    return len(name) <= 63 and bool(_DNS_LABEL.match(name))
+
+
+def _is_label_key(key: str) -> bool:
+    prefix, _, name = key.rpartition("/")
+    if "/" in key and (len(prefix) > 253 or not _DNS_SUBDOMAIN.match(prefix)):
+        return False
+    return len(name) <= 63 and bool(_LABEL_NAME.match(name))
+
+
+def _is_label_value(value: str) -> bool:
+    return not value or (len(value) <= 63 and bool(_LABEL_NAME.match(value)))
+
+
+def _parse_selector(selector: str) -> Dict[str, str]:
+    return dict(item.split("=", 1) for item in selector.split())
+
+
+def validate_service_allocation(config):
+    priority = config.get("service-allocation-priority") or 0
+    if priority < 0:
+        return False, "service-allocation-priority must not be negative"
+
+    for name in (config.get("service-allocation-namespaces") or "").split():
+        if not _is_namespace_name(name):
+            return False, f"{name} is not a valid namespace name"
+
+    for key in ("service-allocation-namespace-selector", "service-allocation-service-selector"):
+        for item in (config.get(key) or "").split():
+            label, _, value = item.partition("=")
+            if "=" not in item or not _is_label_key(label) or not _is_label_value(value):
+                return False, f"{item} is not a valid key=value pair in {key}"
+
+    return True, ""
+
+
+def service_allocation(config) -> Optional[Dict]:
+    """Build the IPAddressPool serviceAllocation spec from charm config.
+
+    Returns None when no allocation scope is configured, leaving the pool open to
+    every LoadBalancer service in the cluster.
+    """
+    allocation = {}
+    priority = config.get("service-allocation-priority") or 0
+    if priority:
+        allocation["priority"] = priority
+    namespaces = (config.get("service-allocation-namespaces") or "").split()
+    if namespaces:
+        allocation["namespaces"] = namespaces
+    ns_selector = _parse_selector(config.get("service-allocation-namespace-selector") or "")
+    if ns_selector:
+        allocation["namespaceSelectors"] = [{"matchLabels": ns_selector}]
+    svc_selector = _parse_selector(config.get("service-allocation-service-selector") or "")
+    if svc_selector:
+        allocation["serviceSelectors"] = [{"matchLabels": svc_selector}]
+    return allocation or None
+
+
 @contextlib.contextmanager
 def _block_on_forbidden(unit: ops.model.Unit):
     try:
@@ -92,11 +187,6 @@ class MetallbCharm(ops.CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
-        if not self.unit.is_leader():
-            self.unit.status = BlockedStatus("MetalLB charm cannot be scaled > n1.")
-            logger.error(f"{self} was initialized without leadership.")
-            return
-
         self.native_manifest = MetallbNativeManifest(self, self.config)
         self.native_collector = Collector(self.native_manifest)
         self.client = Client(namespace=self.model.name, field_manager=self.app.name)
@@ -122,9 +212,61 @@ class MetallbCharm(ops.CharmBase):
         self.framework.observe(self.on.install, self._install_or_upgrade)
         self.framework.observe(self.on.upgrade_charm, self._install_or_upgrade)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.leader_elected, self._on_leader_elected)
         self.framework.observe(self.on.update_status, self._update_status)
         self.framework.observe(self.on.remove, self._cleanup)
-        self._stored.set_default(configured=False)
+        self.framework.observe(self.on.rollback_action, self._on_rollback_action)
+        self._stored.set_default(
+            configured=False,
+            applied="",
+            last_good="",
+            warm="",
+            failover="",
+            rollback="",
+            leader="",
+        )
+
+    def _load_state(self, key) -> Dict:
+        # prefer the state shared by the leader, so it survives a change of leadership
+        relation = self.model.get_relation(PEER_RELATION)
+        raw = None
+        if relation:
+            raw = relation.data[self.app].get(key)
+        if not raw:
+            raw = getattr(self._stored, key)
+        return json.loads(raw) if raw else {}
+
+    def _save_state(self, key, state: Dict):
+        raw = json.dumps(state, sort_keys=True)
+        setattr(self._stored, key, raw)
+        relation = self.model.get_relation(PEER_RELATION)
+        if relation and self.unit.is_leader():
+            relation.data[self.app][key] = raw
+
+    def _render_key(self, manifest: Optional[MetallbNativeManifest] = None) -> Dict:
+        # a newer charm revision may render the same config differently
+        manifest = manifest or self.native_manifest
+        return {
+            "config": {key: manifest.charm_config.get(key) for key in MANIFEST_CONFIG_KEYS},
+            "release": manifest.current_release,
+            "revision": _manifest_revision(manifest),
+        }
+
+    def _cached_digests(self, render_key, recorded) -> Dict[str, str]:
+        warm = json.loads(self._stored.warm) if self._stored.warm else {}
+        for cached in (recorded, warm):
+            if all(cached.get(key) == value for key, value in render_key.items()):
+                return cached.get("digests", {})
+        return _manifest_digests(self.native_manifest.resources)
+
+    def _standby(self):
+        # render while idle, so a failover only has to compare digests
+        render_key = self._render_key()
+        warm = json.loads(self._stored.warm) if self._stored.warm else {}
+        if any(warm.get(key) != value for key, value in render_key.items()):
+            digests = _manifest_digests(self.native_manifest.resources)
+            self._stored.warm = json.dumps(dict(render_key, digests=digests), sort_keys=True)
+        self.unit.status = ActiveStatus("Standby")
 
     def _confirm_resource(self, resource, name) -> bool:
         try:
@@ -141,7 +283,11 @@ class MetallbCharm(ops.CharmBase):
                 return False
         return True
 
-    def _update_status(self, _):
+    def _update_status(self, event):
+        if not self.unit.is_leader():
+            self._standby()
+            return
+
         if not self._stored.configured:
             logger.info("Waiting for configuration to be applied")
             return
@@ -165,22 +311,156 @@ class MetallbCharm(ops.CharmBase):
         self.unit.status = ActiveStatus("Ready")
         self.unit.set_workload_version(self.native_collector.short_version)
         self.app.status = ActiveStatus(self.native_collector.long_version)
+        self._save_state("leader", {"unit": self.unit.name, "seen": time.time()})
+        self._mark_failover_active()
+        # never trust the hook which applied a change, wait for a later update-status
+        if isinstance(event, ops.UpdateStatusEvent):
+            self._record_last_good()
+
+    def _rollout_pending(self) -> List[str]:
+        pending = []
+        for rsc in self.native_manifest.resources:
+            if rsc.kind not in ("Deployment", "DaemonSet"):
+                continue
+            try:
+                obj = self.client.get(type(rsc.resource), rsc.name, namespace=rsc.namespace)
+            except ApiError:
+                logger.exception("Cannot confirm the rollout of %s", rsc)
+                pending.append(str(rsc))
+                continue
+            status, generation = obj.status, obj.metadata.generation or 0
+            if not status or (status.observedGeneration or 0) < generation:
+                pending.append(str(rsc))
+            elif isinstance(obj, Deployment):
+                replicas = 1 if obj.spec.replicas is None else obj.spec.replicas
+                if (status.updatedReplicas or 0) < replicas:
+                    pending.append(str(rsc))
+            elif isinstance(obj, DaemonSet):
+                desired = status.desiredNumberScheduled or 0
+                if not desired or status.numberReady != desired:
+                    pending.append(str(rsc))
+        return pending
+
+    def _record_last_good(self):
+        applied = self._load_state("applied")
+        if not applied or applied == self._load_state("last_good"):
+            return
+        pending = self._rollout_pending()
+        if pending:
+            logger.info("Rollout still in progress, not recording last-known-good: %s", pending)
+            return
+
+        self._save_state("last_good", applied)
+        logger.info("Recorded last-known-good MetalLB config %s", applied["config"])
 
     def _install_or_upgrade(self, event):
+        if not self.unit.is_leader():
+            self._standby()
+            return
+
         logger.info("Installing MetalLB native manifest resources ...")
+        manifest = self.native_manifest
+        if self._held_rollback():
+            # the charm config still holds what was rolled back, keep rendering the snapshot
+            manifest = MetallbNativeManifest(self, self._load_state("last_good")["config"])
         with _block_on_forbidden(self.unit):
-            self.native_manifest.apply_manifests()
+            resources = list(manifest.resources)
+            manifest.apply_resources(*resources)
+            applied = self._load_state("applied")
+            if applied:
+                # an upgrade may bundle a different default release, keep the record current
+                applied.update(self._render_key(manifest), digests=_manifest_digests(resources))
+                self._save_state("applied", applied)
             self.unit.status = WaitingStatus("Waiting for MetalLB resources to be configured")
             logger.info("MetalLB native manifest has been installed")
 
     def _cleanup(self, event):
+        if not self.unit.is_leader():
+            logger.info("MetalLB resources are cleaned up by the leader")
+            return
+        if self.app.planned_units() > 0:
+            logger.info("Other units remain, leaving MetalLB resources in place")
+            return
+
         self.unit.status = MaintenanceStatus("Cleaning up MetalLB resources")
         with _block_on_forbidden(self.unit):
             self.native_manifest.delete_manifests(ignore_unauthorized=True, ignore_not_found=True)
             self.unit.status = MaintenanceStatus("Shutting down")
 
     def _on_config_changed(self, event):
+        if not self.unit.is_leader():
+            self._standby()
+            return
+        if self._rollback_in_effect():
+            return
+
         logger.info("Updating MetalLB IPAddressPool to reflect charm configuration")
+        self._reconcile()
+
+    def _held_rollback(self) -> bool:
+        rollback = self._load_state("rollback")
+        return bool(rollback) and rollback["config"] == dict(self.config)
+
+    def _rollback_in_effect(self) -> bool:
+        if self._held_rollback():
+            logger.info("Rollback in effect, charm config is unchanged since it was run")
+            # the rolled back objects are already applied, possibly by a previous leader
+            self._stored.configured = True
+            self._update_status(None)
+            return True
+        if not self._load_state("rollback"):
+            return False
+        logger.info("Charm config changed since the rollback, reconciling")
+        self._save_state("rollback", {})
+        return False
+
+    def _on_leader_elected(self, event):
+        if self._rollback_in_effect():
+            return
+
+        elected_at = time.time()
+        recorded = self._load_state("applied")
+        if not recorded:
+            # first-time setup is left to config-changed, which follows on a fresh deploy
+            logger.info("No state recorded by a previous leader, waiting for config-changed")
+            return
+
+        previous = self._load_state("leader")
+        logger.info("Reconciling MetalLB against the state recorded by the last leader")
+        applied = self._reconcile(recorded)
+        if applied is None:
+            return
+
+        reconciled_at = time.time()
+        failover = {
+            "unit": self.unit.name,
+            "objects": applied,
+            "elected_at": elected_at,
+            "reconcile_seconds": round(reconciled_at - elected_at, 3),
+            "previous_leader": previous.get("unit"),
+        }
+        if previous.get("seen"):
+            # the previous leader's last heartbeat bounds when it was lost
+            failover["since_previous_leader_seconds"] = round(reconciled_at - previous["seen"], 3)
+        logger.info("Leader failover reconciled %d objects: %s", len(applied), failover)
+        self._save_state("failover", failover)
+        if self.unit.status == ActiveStatus("Ready"):
+            self._mark_failover_active()
+
+    def _mark_failover_active(self):
+        failover = self._load_state("failover")
+        if failover.get("unit") != self.unit.name or "to_active_seconds" in failover:
+            return
+        failover["to_active_seconds"] = round(time.time() - failover["elected_at"], 3)
+        logger.info("Leader failover reached Active in %.2fs", failover["to_active_seconds"])
+        self._save_state("failover", failover)
+
+    def _reconcile(self, recorded: Optional[Dict] = None) -> Optional[List[str]]:
+        """Apply the charm configuration, returning the objects which were applied.
+
+        Without a recorded state every object is applied; otherwise only those which
+        differ from it. Returns None when the configuration could not be applied.
+        """
         self._stored.configured = False
         # strip all whitespace from string
         stripped = "".join(self.config["iprange"].split())
@@ -189,17 +469,100 @@ class MetallbCharm(ops.CharmBase):
             err_msg = f"Invalid iprange: {msg}"
             logger.error(err_msg)
             self.unit.status = BlockedStatus(err_msg)
-            return
+            return None
+
+        valid_allocation, msg = validate_service_allocation(self.config)
+        if not valid_allocation:
+            err_msg = f"Invalid service allocation: {msg}"
+            logger.error(err_msg)
+            self.unit.status = BlockedStatus(err_msg)
+            return None
 
         addresses = stripped.split(",")
+        allocation = service_allocation(self.config)
+        pool_spec = {"addresses": addresses}
+        if allocation:
+            pool_spec["serviceAllocation"] = allocation
         with _block_on_forbidden(self.unit):
+            missing = self._missing_allocation_namespaces(allocation)
+            if missing:
+                err_msg = f"Invalid service allocation: namespaces not found: {', '.join(missing)}"
+                logger.error(err_msg)
+                self.unit.status = BlockedStatus(err_msg)
+                return None
+
             self.unit.status = MaintenanceStatus("Updating Manifests")
-            self.native_manifest.apply_manifests()
+            render_key, l2_spec = self._render_key(), self._l2_adv_spec()
+            if recorded is None:
+                resources = list(self.native_manifest.resources)
+                digests = _manifest_digests(resources)
+            else:
+                digests = self._cached_digests(render_key, recorded)
+                changed = {
+                    key
+                    for key, value in digests.items()
+                    if recorded.get("digests", {}).get(key) != value
+                }
+                resources = []
+                if changed:
+                    resources = [
+                        rsc for rsc in self.native_manifest.resources if str(rsc) in changed
+                    ]
+            if resources:
+                self.native_manifest.apply_resources(*resources)
+            applied = [str(rsc) for rsc in resources]
+
             self.unit.status = MaintenanceStatus("Updating Configuration")
-            self._update_ip_pool(addresses)
-            self._update_l2_adv()
+            if self._update_ip_pool(pool_spec):
+                applied.append(f"IPAddressPool/{self.pool_name}")
+            if recorded is None or recorded["l2_adv"] != l2_spec:
+                self._update_l2_adv()
+                applied.append(f"L2Advertisement/{self.l2_adv_name}")
+            self._save_state(
+                "applied",
+                dict(render_key, digests=digests, ip_pool=pool_spec, l2_adv=l2_spec),
+            )
             self._stored.configured = True
-            self._update_status(event)
+            self._update_status(None)
+            return applied
+        return None
+
+    def _missing_allocation_namespaces(self, allocation):
+        if not allocation:
+            return []
+
+        missing = []
+        for name in allocation.get("namespaces", []):
+            try:
+                self.client.get(Namespace, name=name)
+            except ApiError as e:
+                if e.status.code != 404:
+                    raise
+                missing.append(name)
+
+        # selectors may legitimately match objects created later, so only warn
+        for selector in allocation.get("namespaceSelectors", []):
+            if not any(self.client.list(Namespace, labels=selector["matchLabels"])):
+                logger.warning("No namespaces match selector %s", selector["matchLabels"])
+        for selector in allocation.get("serviceSelectors", []):
+            if not any(self.client.list(Service, namespace="*", labels=selector["matchLabels"])):
+                logger.warning("No services match selector %s", selector["matchLabels"])
+        return missing
+
+    def _ip_pool_changed(self, spec) -> bool:
+        try:
+            current = self.client.get(
+                self.IPAddressPool, name=self.pool_name, namespace=self.config["namespace"]
+            )
+        except ApiError as e:
+            if e.status.code == 404:
+                return True
+            raise
+        # only compare the fields owned by the charm, the API server defaults the rest
+        current_spec = current.spec or {}
+        return any(
+            current_spec.get(key) != spec.get(key) for key in ("addresses", "serviceAllocation")
+        )
 
     # retrying is necessary as the ip address pool webhooks take some time to come up
     @retry(
@@ -209,22 +572,93 @@ class MetallbCharm(ops.CharmBase):
         before=before_log(logger, logging.WARNING),
         wait=wait_exponential(multiplier=1, min=2, max=60 * 2),
     )
-    def _update_ip_pool(self, addresses):
+    def _update_ip_pool(self, spec) -> bool:
+        if not self._ip_pool_changed(spec):
+            logger.info("IPAddressPool %s is unchanged, skipping apply", self.pool_name)
+            return False
+
         ip_pool = self.IPAddressPool(
             metadata={"name": self.pool_name, "namespace": self.config["namespace"]},
-            spec={"addresses": addresses},
+            spec=spec,
         )
 
         self.client.apply(ip_pool, force=True)
+        return True
+
+    def _l2_adv_spec(self):
+        return {"ipAddressPools": [self.pool_name]}
 
-    def _update_l2_adv(self):
+    def _update_l2_adv(self, spec=None):
         l2_adv = self.L2Advertisement(
             metadata={"name": self.l2_adv_name, "namespace": self.config["namespace"]},
-            spec={"ipAddressPools": [self.pool_name]},
+            spec=spec or self._l2_adv_spec(),
         )
 
         self.client.apply(l2_adv, force=True)
 
+    def _on_rollback_action(self, event):
+        if not self.unit.is_leader():
+            event.fail("rollback must be run on the leader unit")
+            return
+
+        last_good = self._load_state("last_good")
+        if not last_good:
+            event.fail("No last-known-good snapshot has been recorded")
+            return
+
+        begin = time.monotonic()
+        applied = self._load_state("applied")
+        current_digests = applied.get("digests", {})
+
+        # manifest resources are rendered in file order, which keeps namespaces and
+        # CRDs ahead of the objects depending on them
+        good_manifest = MetallbNativeManifest(self, last_good["config"])
+        good_resources = list(good_manifest.resources)
+        good_digests = _manifest_digests(good_resources)
+        changed = [
+            rsc
+            for rsc in good_resources
+            if current_digests.get(str(rsc)) != good_digests[str(rsc)]
+        ]
+        rolled_back = [str(rsc) for rsc in changed]
+
+        completed = False
+        with _block_on_forbidden(self.unit):
+            self._stored.configured = False
+            self.unit.status = MaintenanceStatus("Rolling back to last-known-good")
+            if changed:
+                good_manifest.apply_resources(*changed)
+            if applied.get("ip_pool") != last_good["ip_pool"]:
+                self._update_ip_pool(last_good["ip_pool"])
+                rolled_back.append(f"IPAddressPool/{self.pool_name}")
+            if applied.get("l2_adv") != last_good["l2_adv"]:
+                self._update_l2_adv(last_good["l2_adv"])
+                rolled_back.append(f"L2Advertisement/{self.l2_adv_name}")
+            self._save_state(
+                "applied",
+                dict(last_good, **self._render_key(good_manifest), digests=good_digests),
+            )
+            # keep the rollback until the charm config next changes
+            self._save_state("rollback", {"config": dict(self.config)})
+            self._stored.configured = True
+            self._update_status(event)
+            completed = True
+
+        if not completed:
+            event.fail("API Access Forbidden, deploy with --trust?")
+            return
+
+        elapsed = time.monotonic() - begin
+        logger.info("Rolled back %d objects in %.2fs", len(rolled_back), elapsed)
+        event.set_results(
+            {
+                "release": good_manifest.current_release,
+                "objects": ", ".join(rolled_back) or "none",
+                "count": len(rolled_back),
+                "duration": f"{elapsed:.2f}s",
+            }
+        )
+
 
 if __name__ == "__main__":  # pragma: nocover
     main(MetallbCharm)
@@ -18,6 +18,63 @@ def pytest_addoption(parser):
         default="10.1.240.240-10.1.240.241",
         help="Juju controller to use",
     )
+    parser.addoption(
+        "--scale",
+        action="store",
+        default="",
+        help="Comma-separated LoadBalancer service counts for the opt-in scale test",
+    )
+    parser.addoption(
+        "--scale-pool-sizes",
+        action="store",
+        default="8192",
+        help="Comma-separated IPAddressPool sizes to repeat the scale test across",
+    )
+    parser.addoption(
+        "--scale-cidr",
+        action="store",
+        default="10.64.0.0/16",
+        help="Network from which the scale test IPAddressPools are carved",
+    )
+    parser.addoption(
+        "--scale-node-selectors",
+        action="store",
+        default="kubernetes.io/os=linux",
+        help="Semicolon-separated node-selector values to repeat the scale test across",
+    )
+    parser.addoption(
+        "--scale-report",
+        action="store",
+        default="",
+        help="File to append scale test results to, one JSON object per line",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--scale"):
+        return
+    skip_scale = pytest.mark.skip(reason="scale tests only run with --scale")
+    for item in items:
+        if "scale" in item.keywords:
+            item.add_marker(skip_scale)
+
+
+def pytest_generate_tests(metafunc):
+    if "scale_case" not in metafunc.fixturenames:
+        return
+    opt = metafunc.config.getoption
+    counts = [int(count) for count in opt("--scale").split(",") if count] or [0]
+    pool_sizes = [int(size) for size in opt("--scale-pool-sizes").split(",") if size]
+    selectors = [selector.strip() for selector in opt("--scale-node-selectors").split(";")]
+    cases = [
+        (count, size, selector)
+        for selector in selectors
+        for size in pool_sizes
+        for count in counts
+    ]
+    metafunc.parametrize(
+        "scale_case", cases, ids=[f"{c}svc-{s}ips-{n or 'any'}" for c, s, n in cases]
+    )
 
 
 @pytest.fixture
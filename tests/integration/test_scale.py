@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import ipaddress
+import json
+import logging
+import math
+import threading
+import time
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+import yaml
+from lightkube import Client
+from lightkube.core.exceptions import ApiError
+from lightkube.generic_resource import create_namespaced_resource
+from lightkube.models.core_v1 import ServicePort, ServiceSpec
+from lightkube.models.meta_v1 import ObjectMeta
+from lightkube.resources.core_v1 import Namespace, Service
+from lightkube.utils.quantity import parse_quantity
+from pytest_operator.plugin import OpsTest
+from tenacity import retry, retry_if_result, stop_after_delay, wait_fixed
+
+logger = logging.getLogger(__name__)
+
+METADATA = yaml.safe_load(Path("./metadata.yaml").read_text())
+APP_NAME = METADATA["name"]
+NAMESPACE = "metallb-system-scale"
+SERVICE_NAMESPACE = "metallb-scale"
+SAMPLE_INTERVAL = 1
+TIMEOUT_PER_SERVICE = 0.5
+
+PodMetrics = create_namespaced_resource(
+    group="metrics.k8s.io",
+    version="v1beta1",
+    kind="PodMetrics",
+    plural="pods",
+)
+
+pytestmark = pytest.mark.scale
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def cpu_millicores(quantity: str) -> Decimal:
+    # metrics-server reports cpu usage in nano or micro cores, which parse_quantity rejects
+    for suffix, scale in (("n", Decimal("1e-6")), ("u", Decimal("1e-3"))):
+        if quantity.endswith(suffix):
+            return Decimal(quantity[:-1]) * scale
+    return parse_quantity(quantity) * 1000
+
+
+def pool_range(cidr: str, size: int) -> str:
+    network = ipaddress.ip_network(cidr)
+    if size > network.num_addresses - 2:
+        raise ValueError(f"Pool size {size} does not fit in {cidr}")
+    first = next(network.hosts())
+    return f"{first}-{first + size - 1}"
+
+
+def sample_usage(client, usage):
+    """Record the peak cpu and memory of the MetalLB controller and speaker pods."""
+    try:
+        pod_metrics = list(client.list(PodMetrics, namespace=NAMESPACE, labels={"app": "metallb"}))
+    except ApiError as e:
+        logger.warning("Pod metrics unavailable: %s", e.status.message)
+        return
+    for pod in pod_metrics:
+        component = (pod.metadata.labels or {}).get("component", pod.metadata.name)
+        cpu = sum(cpu_millicores(c["usage"]["cpu"]) for c in pod["containers"])
+        memory = sum(parse_quantity(c["usage"]["memory"]) for c in pod["containers"]) / 2**20
+        peak = usage.setdefault(component, {"cpu_millicores": 0.0, "memory_mib": 0.0})
+        peak["cpu_millicores"] = max(peak["cpu_millicores"], round(float(cpu), 1))
+        peak["memory_mib"] = max(peak["memory_mib"], round(float(memory), 1))
+
+
+def sample_usage_until(usage, stop):
+    client = Client()
+    while not stop.wait(SAMPLE_INTERVAL):
+        sample_usage(client, usage)
+
+
+def watch_for_ips(observed, stop):
+    """Stamp each service as soon as it is seen with an external IP."""
+    client = Client()
+    for _, svc in client.watch(Service, namespace=SERVICE_NAMESPACE):
+        now = time.monotonic()
+        if stop.is_set():
+            return
+        if svc.status and svc.status.loadBalancer and svc.status.loadBalancer.ingress:
+            observed.setdefault(svc.metadata.name, now)
+
+
+def create_services(client, count):
+    created = {}
+    for idx in range(count):
+        name = f"scale-{idx:05d}"
+        svc = Service(
+            metadata=ObjectMeta(name=name, namespace=SERVICE_NAMESPACE),
+            spec=ServiceSpec(
+                type="LoadBalancer",
+                selector={"app": name},
+                ports=[ServicePort(port=80, targetPort=80)],
+            ),
+        )
+        # stamped before the request, the watch may see the IP before create returns
+        created[name] = time.monotonic()
+        client.create(svc)
+    return created
+
+
+def wait_for_ips(observed, expected, timeout):
+    deadline = time.monotonic() + timeout
+    while len(observed) < expected and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+@retry(
+    retry=retry_if_result(lambda gone: not gone),
+    stop=stop_after_delay(60 * 10),
+    wait=wait_fixed(5),
+)
+def wait_for_namespace_deleted(client, name):
+    try:
+        client.get(Namespace, name)
+    except ApiError as e:
+        if e.status.code == 404:
+            return True
+        raise
+    return False
+
+
+@pytest.mark.abort_on_fail
+async def test_build_and_deploy(ops_test: OpsTest):
+    charm = next(Path().glob("metallb*.charm"), None)
+    if not charm:
+        logger.info("Building charm")
+        charm = await ops_test.build_charm(".")
+
+    await ops_test.model.deploy(
+        charm.resolve(), application_name=APP_NAME, config={"namespace": NAMESPACE}, trust=True
+    )
+    await ops_test.model.wait_for_idle(apps=[APP_NAME], status="active", timeout=60 * 25)
+
+
+async def test_time_to_external_ip(ops_test: OpsTest, client, scale_case, request):
+    """Measure how quickly MetalLB assigns addresses to many LoadBalancer services."""
+    count, pool_size, node_selector = scale_case
+    try:
+        iprange = pool_range(request.config.getoption("--scale-cidr"), pool_size)
+    except ValueError as e:
+        pytest.fail(str(e))
+    app = ops_test.model.applications[APP_NAME]
+    await app.set_config({"iprange": iprange, "node-selector": node_selector})
+    await ops_test.model.wait_for_idle(apps=[APP_NAME], status="active", timeout=60 * 10)
+
+    client.create(Namespace(metadata=ObjectMeta(name=SERVICE_NAMESPACE)))
+    usage, observed, stop = {}, {}, threading.Event()
+    # both threads start before the first service is created and use their own clients
+    threads = [
+        threading.Thread(target=watch_for_ips, args=(observed, stop), daemon=True),
+        threading.Thread(target=sample_usage_until, args=(usage, stop), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        begin = time.monotonic()
+        created = create_services(client, count)
+        logger.info("Created %d services in %.1fs", count, time.monotonic() - begin)
+        wait_for_ips(observed, min(count, pool_size), 60 + TIMEOUT_PER_SERVICE * count)
+    finally:
+        stop.set()
+        # deleting the namespace emits events which wake the watch so it can exit
+        client.delete(Namespace, SERVICE_NAMESPACE)
+        wait_for_namespace_deleted(client, SERVICE_NAMESPACE)
+        for thread in threads:
+            thread.join(timeout=30)
+
+    latencies = [observed[name] - created[name] for name in observed if name in created]
+    result = {
+        "services": count,
+        "pool_size": pool_size,
+        "node_selector": node_selector,
+        "assigned": len(latencies),
+        "p50_seconds": percentile(latencies, 50),
+        "p99_seconds": percentile(latencies, 99),
+        "usage": usage,
+    }
+    logger.info("Scale result: %s", json.dumps(result))
+    report = request.config.getoption("--scale-report")
+    if report:
+        with open(report, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+    # services beyond the pool's capacity are expected to remain pending
+    assert len(latencies) == min(count, pool_size)
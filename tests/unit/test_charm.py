@@ -3,6 +3,8 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import copy
+import json
 import unittest.mock as mock
 
 import ops
@@ -10,6 +12,8 @@ import ops.testing
 import pytest
 import yaml
 from lightkube.core.exceptions import ApiError
+from lightkube.models.apps_v1 import DaemonSetStatus, DeploymentStatus
+from lightkube.resources.apps_v1 import DaemonSet, Deployment
 from ops import ActiveStatus, BlockedStatus, WaitingStatus
 from ops.testing import Harness
 
@@ -28,9 +32,18 @@ def harness():
         harness.cleanup()
 
 
-def test_not_leader(harness):
+def test_not_leader(harness, lk_manifests_client, lk_charm_client):
     harness.begin()
-    assert harness.charm.model.unit.status == BlockedStatus("MetalLB charm cannot be scaled > n1.")
+    harness.charm.on.install.emit()
+    harness.update_config({"node-selector": "kubernetes.io/arch=amd64"})
+    assert harness.charm.model.unit.status == ActiveStatus("Standby")
+    lk_manifests_client.apply.assert_not_called()
+    lk_charm_client.apply.assert_not_called()
+
+    # the standby renders the manifests ahead of a failover
+    warm = json.loads(harness.charm._stored.warm)
+    assert warm["config"]["node-selector"] == "kubernetes.io/arch=amd64"
+    assert "Deployment/metallb-system/controller" in warm["digests"]
 
 
 def test_install_applies_manifest_objects(harness, lk_manifests_client):
@@ -150,6 +163,7 @@ def test_remove_deletes_manifest_objects(harness, lk_manifests_client):
     # Test that the remove-handler deletes the objects specified in the manifest
     lk_manifests_client.reset_mock()
     harness.set_leader(True)
+    harness.set_planned_units(0)
     harness.begin()
     harness.charm.on.remove.emit()
 
@@ -223,3 +237,348 @@ def test_empty_config_option_not_used_by_manifest(harness):
     harness.begin()
     manifest = MetallbNativeManifest(harness.charm, harness.charm.config)
     assert "iprange" not in manifest.config
+
+
+def test_config_change_sets_service_allocation(harness, lk_charm_client):
+    harness.set_leader(True)
+    harness.begin()
+
+    lk_charm_client.reset_mock()
+    harness.update_config(
+        {
+            "service-allocation-namespaces": "tenant-a tenant-b",
+            "service-allocation-namespace-selector": "team=a",
+            "service-allocation-service-selector": "pool=a tier=web",
+            "service-allocation-priority": 10,
+        }
+    )
+    assert len(lk_charm_client.apply.call_args_list) == 2
+    call_obj = lk_charm_client.apply.call_args_list[0].args[0].to_dict()
+    assert call_obj["spec"]["serviceAllocation"] == {
+        "priority": 10,
+        "namespaces": ["tenant-a", "tenant-b"],
+        "namespaceSelectors": [{"matchLabels": {"team": "a"}}],
+        "serviceSelectors": [{"matchLabels": {"pool": "a", "tier": "web"}}],
+    }
+
+    # pool already matches the desired scope, only the L2Advertisement is applied
+    lk_charm_client.reset_mock()
+    lk_charm_client.get.return_value.spec = {
+        "addresses": ["192.168.1.240-192.168.1.247"],
+        "autoAssign": True,
+        **call_obj["spec"],
+    }
+    harness.charm.on.config_changed.emit()
+    assert len(lk_charm_client.apply.call_args_list) == 1
+    call_obj = lk_charm_client.apply.call_args_list[0].args[0].to_dict()
+    assert call_obj["spec"] == {"ipAddressPools": ["None-metallb"]}
+
+
+def test_config_change_invalid_service_allocation(harness, lk_charm_client):
+    harness.set_leader(True)
+    harness.begin()
+
+    harness.update_config({"service-allocation-priority": -1})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid service allocation: service-allocation-priority must not be negative"
+    )
+
+    harness.update_config(
+        {"service-allocation-priority": 0, "service-allocation-service-selector": "pool"}
+    )
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid service allocation: pool is not a valid key=value pair in "
+        "service-allocation-service-selector"
+    )
+
+    # label keys, values and namespace names follow the kubernetes syntax
+    harness.update_config({"service-allocation-service-selector": ""})
+    for option, value, item in [
+        ("service-allocation-namespace-selector", "team=a/b", "team=a/b"),
+        ("service-allocation-service-selector", "a=b=c", "a=b=c"),
+        ("service-allocation-service-selector", "bad_prefix/tier=web", "bad_prefix/tier=web"),
+    ]:
+        lk_charm_client.reset_mock()
+        harness.update_config({option: value})
+        lk_charm_client.list.assert_not_called()
+        assert harness.charm.model.unit.status == BlockedStatus(
+            f"Invalid service allocation: {item} is not a valid key=value pair in {option}"
+        )
+        harness.update_config({option: ""})
+    harness.update_config({"service-allocation-namespaces": "Tenant_A"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid service allocation: Tenant_A is not a valid namespace name"
+    )
+
+    # namespaces are validated against the live cluster
+    lk_charm_client.reset_mock()
+    api_error = ApiError(response=mock.MagicMock())
+    api_error.status.code = 404
+    lk_charm_client.get.side_effect = api_error
+    harness.update_config(
+        {"service-allocation-service-selector": "", "service-allocation-namespaces": "tenant-a"}
+    )
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid service allocation: namespaces not found: tenant-a"
+    )
+    lk_charm_client.apply.assert_not_called()
+
+
+def test_rollback_without_snapshot(harness):
+    harness.set_leader(True)
+    harness.begin()
+    with pytest.raises(ops.testing.ActionFailed) as exc:
+        harness.run_action("rollback")
+    assert exc.value.message == "No last-known-good snapshot has been recorded"
+
+
+@pytest.fixture
+def cluster(harness, lk_manifests_client, lk_charm_client):
+    """Serve the rendered manifest objects as installed, rolling out when `ready`."""
+    state = {"ready": True}
+
+    def installed(res, name, namespace=None):
+        for rsc in harness.charm.native_manifest.resources:
+            if type(rsc.resource) is res and rsc.name == name:
+                return copy.deepcopy(rsc.resource)
+        raise ApiError(response=mock.MagicMock())
+
+    def rolled_out(res, name=None, namespace=None):
+        if res not in (Deployment, DaemonSet):
+            return mock.MagicMock()
+        obj = installed(res, name, namespace)
+        obj.metadata.generation = 1
+        ready = 1 if state["ready"] else 0
+        if res is Deployment:
+            obj.status = DeploymentStatus(observedGeneration=1, updatedReplicas=ready)
+        else:
+            obj.status = DaemonSetStatus(
+                observedGeneration=1,
+                currentNumberScheduled=1,
+                desiredNumberScheduled=1,
+                numberMisscheduled=0,
+                numberReady=ready,
+            )
+        return obj
+
+    lk_manifests_client.get.side_effect = installed
+    lk_charm_client.get.side_effect = rolled_out
+    yield state
+
+
+def test_last_good_waits_for_rollout(harness, cluster):
+    harness.set_leader(True)
+    harness.begin()
+
+    # the hook applying a change never records it as last-known-good
+    harness.update_config({"iprange": "10.1.240.240-10.1.240.241"})
+    assert harness.charm.model.unit.status == ActiveStatus("Ready")
+    assert harness.charm._load_state("last_good") == {}
+
+    harness.charm.on.update_status.emit()
+    assert harness.charm._load_state("last_good")["config"]["node-selector"] == (
+        "kubernetes.io/os=linux"
+    )
+
+    # a bad node-selector leaves the speakers unscheduled
+    cluster["ready"] = False
+    harness.update_config({"node-selector": "bogus=1"})
+    harness.charm.on.update_status.emit()
+    assert harness.charm._load_state("last_good")["config"]["node-selector"] == (
+        "kubernetes.io/os=linux"
+    )
+
+
+def test_rollback_applies_changed_objects(harness, cluster, lk_manifests_client, lk_charm_client):
+    harness.set_leader(True)
+    harness.begin()
+    harness.update_config({"iprange": "10.1.240.240-10.1.240.241"})
+    harness.charm.on.update_status.emit()
+
+    cluster["ready"] = False
+    harness.update_config({"node-selector": "bogus=1"})
+    harness.charm.on.update_status.emit()
+
+    lk_manifests_client.reset_mock()
+    lk_charm_client.reset_mock()
+    cluster["ready"] = True
+    output = harness.run_action("rollback")
+
+    assert harness.charm.model.unit.status == ActiveStatus("Ready")
+    applied = [call.args[0] for call in lk_manifests_client.apply.call_args_list]
+    assert sorted(obj.kind for obj in applied) == ["DaemonSet", "Deployment"]
+    for obj in applied:
+        assert obj.spec.template.spec.nodeSelector == {"kubernetes.io/os": "linux"}
+    assert output.results["count"] == 2
+    assert output.results["release"] == "v0.13.10"
+    lk_charm_client.apply.assert_not_called()
+    assert harness.charm._load_state("applied")["config"]["node-selector"] == (
+        "kubernetes.io/os=linux"
+    )
+
+    # the rollback holds across hooks and leadership until the charm config changes
+    lk_manifests_client.reset_mock()
+    harness.charm.on.config_changed.emit()
+    harness.set_leader(False)
+    harness.set_leader(True)
+    lk_manifests_client.apply.assert_not_called()
+
+    # an upgrade keeps rendering the rolled back config
+    harness.charm.on.upgrade_charm.emit()
+    applied = [call.args[0] for call in lk_manifests_client.apply.call_args_list]
+    for obj in applied:
+        if obj.kind in ("DaemonSet", "Deployment"):
+            assert obj.spec.template.spec.nodeSelector == {"kubernetes.io/os": "linux"}
+    assert harness.charm._load_state("applied")["config"]["node-selector"] == (
+        "kubernetes.io/os=linux"
+    )
+    assert harness.charm._load_state("rollback")
+
+    harness.update_config({"node-selector": "kubernetes.io/os=linux"})
+    assert harness.charm._load_state("rollback") == {}
+
+
+def test_rollback_held_on_new_leader(harness, cluster):
+    rel_id = harness.add_relation("replicas", "metallb")
+    harness.begin()
+    config = dict(harness.charm.config)
+    harness.update_relation_data(
+        rel_id,
+        "metallb",
+        {
+            "applied": json.dumps({"config": {}, "digests": {}, "ip_pool": {}, "l2_adv": {}}),
+            "rollback": json.dumps({"config": config}),
+        },
+    )
+    harness.charm.on.update_status.emit()
+    assert harness.charm.model.unit.status == ActiveStatus("Standby")
+
+    harness.set_leader(True)
+    assert harness.charm.model.unit.status == ActiveStatus("Ready")
+    harness.charm.on.update_status.emit()
+    assert harness.charm.model.unit.status == ActiveStatus("Ready")
+
+
+def test_rollback_forbidden(harness, lk_manifests_client):
+    harness.set_leader(True)
+    harness.begin()
+    harness.update_config({"iprange": "10.1.240.240-10.1.240.241"})
+    applied = harness.charm._load_state("applied")
+    harness.charm._save_state("last_good", applied)
+    harness.update_config({"node-selector": "kubernetes.io/arch=amd64"})
+
+    api_error = ApiError(response=mock.MagicMock())
+    api_error.status.code = 403
+    lk_manifests_client.apply.side_effect = api_error
+    with pytest.raises(ops.testing.ActionFailed) as exc:
+        harness.run_action("rollback")
+    assert exc.value.message == "API Access Forbidden, deploy with --trust?"
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "API Access Forbidden, deploy with --trust?"
+    )
+
+
+def test_upgrade_refreshes_applied_digests(harness):
+    harness.set_leader(True)
+    harness.begin()
+    harness.update_config({"iprange": "10.1.240.240-10.1.240.241"})
+    applied = harness.charm._load_state("applied")
+    harness.charm._save_state("applied", dict(applied, digests={}))
+
+    harness.charm.on.upgrade_charm.emit()
+    refreshed = harness.charm._load_state("applied")
+    assert refreshed["digests"] == applied["digests"]
+    assert refreshed["ip_pool"] == applied["ip_pool"]
+
+
+def test_remove_with_remaining_units_keeps_manifest_objects(harness, lk_manifests_client):
+    harness.set_leader(True)
+    harness.set_planned_units(1)
+    harness.begin()
+    harness.charm.on.remove.emit()
+    lk_manifests_client.delete.assert_not_called()
+
+
+def test_leader_elected_reconciles_changed_objects(harness, lk_manifests_client, lk_charm_client):
+    rel_id = harness.add_relation("replicas", "metallb")
+    harness.set_leader(True)
+    harness.begin()
+    harness.update_config({"iprange": "10.1.240.240-10.1.240.241"})
+    recorded = json.loads(harness.get_relation_data(rel_id, "metallb")["applied"])
+    lk_charm_client.get.return_value.spec = recorded["ip_pool"]
+
+    # leadership moves away, config changes while this unit is on standby
+    harness.set_leader(False)
+    harness.update_config({"node-selector": "kubernetes.io/arch=amd64"})
+    assert harness.charm.model.unit.status == ActiveStatus("Standby")
+
+    lk_manifests_client.reset_mock()
+    lk_charm_client.reset_mock()
+    harness.set_leader(True)
+
+    applied = [call.args[0] for call in lk_manifests_client.apply.call_args_list]
+    assert sorted(obj.kind for obj in applied) == ["DaemonSet", "Deployment"]
+    lk_charm_client.apply.assert_not_called()
+    failover = json.loads(harness.get_relation_data(rel_id, "metallb")["failover"])
+    assert failover["unit"] == "metallb/0"
+    assert sorted(failover["objects"]) == [
+        "DaemonSet/metallb-system/speaker",
+        "Deployment/metallb-system/controller",
+    ]
+
+    # a later failover with nothing changed applies nothing
+    lk_manifests_client.reset_mock()
+    harness.set_leader(False)
+    harness.set_leader(True)
+    lk_manifests_client.apply.assert_not_called()
+    lk_charm_client.apply.assert_not_called()
+
+
+def test_leader_elected_without_recorded_state(harness, lk_manifests_client, lk_charm_client):
+    rel_id = harness.add_relation("replicas", "metallb")
+    harness.begin()
+    lk_manifests_client.reset_mock()
+    harness.set_leader(True)
+    lk_manifests_client.apply.assert_not_called()
+    lk_charm_client.apply.assert_not_called()
+    assert "failover" not in harness.get_relation_data(rel_id, "metallb")
+
+
+def test_leader_elected_rerenders_other_revision(harness, lk_manifests_client, lk_charm_client):
+    rel_id = harness.add_relation("replicas", "metallb")
+    harness.set_leader(True)
+    harness.begin()
+    harness.update_config({"iprange": "10.1.240.240-10.1.240.241"})
+    recorded = json.loads(harness.get_relation_data(rel_id, "metallb")["applied"])
+    lk_charm_client.get.return_value.spec = recorded["ip_pool"]
+
+    # the previous leader ran a charm revision bundling a different controller manifest
+    recorded["revision"] = "previous"
+    recorded["digests"]["Deployment/metallb-system/controller"] = "previous"
+    harness.set_leader(False)
+    harness.update_relation_data(rel_id, "metallb", {"applied": json.dumps(recorded)})
+
+    lk_manifests_client.reset_mock()
+    harness.set_leader(True)
+    applied = [call.args[0] for call in lk_manifests_client.apply.call_args_list]
+    assert [obj.kind for obj in applied] == ["Deployment"]
+
+
+def test_failover_timing(harness, cluster):
+    rel_id = harness.add_relation("replicas", "metallb")
+    harness.set_leader(True)
+    harness.begin()
+    harness.update_config({"iprange": "10.1.240.240-10.1.240.241"})
+    harness.charm.on.update_status.emit()
+    data = harness.get_relation_data(rel_id, "metallb")
+    seen = json.loads(data["leader"])["seen"]
+
+    harness.set_leader(False)
+    with mock.patch("charm.time.time", return_value=seen + 30):
+        harness.set_leader(True)
+
+    failover = json.loads(harness.get_relation_data(rel_id, "metallb")["failover"])
+    assert failover["previous_leader"] == "metallb/0"
+    assert failover["since_previous_leader_seconds"] == 30
+    assert failover["reconcile_seconds"] == 0
+    assert failover["to_active_seconds"] == 0